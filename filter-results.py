@@ -1,16 +1,78 @@
 import csv
 import aiohttp
 import asyncio
-import json
+import logging
+import logging.handlers
+import queue
+from aiolimiter import AsyncLimiter
+import orjson
 import os
 import re
 from urllib.parse import quote
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime
+from functools import lru_cache
 import unicodedata
+import jellyfish
+from rapidfuzz import fuzz
+
+# Compiled once - normalize_name runs per obituary per row, so per-call
+# re.split compilation and list rebuilds add up
+_SPLIT_RE = re.compile(r'[.\s-]+')
+_STOPWORDS = frozenset({
+    'jr', 'sr', 'ii', 'iii', 'iv', 'v', 'md', 'phd', 'rn', 'np', 'pa',
+    'dr', 'mr', 'mrs', 'ms', 'miss',
+})
+
+
+logger = logging.getLogger(__name__)
+
+
+def setup_logging():
+    """Route log records through a queue drained by a background thread.
+
+    print() takes the GIL and a stdout write syscall per line; under
+    high concurrency that serializes tasks on the terminal. Returns the
+    listener so the caller can stop it (flushing the queue) on exit.
+    """
+    log_queue = queue.Queue(-1)
+    logging.basicConfig(level=logging.INFO, format="%(message)s",
+                        handlers=[logging.handlers.QueueHandler(log_queue)])
+    listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
+    listener.start()
+    return listener
+
+
+@dataclass(slots=True)
+class ObitInfo:
+    """One obituary's match outcome for a license row.
+
+    Slots instead of a per-obit dict: thousands of these stay alive until
+    the final CSV write, and field names double as the JSON keys (orjson
+    serializes dataclasses natively).
+    """
+    name: dict
+    id: str
+    obituaryUrl: str
+    match_reason: str
+    is_match: bool
+
+
+# Minimum token_set_ratio for the fuzzy fallback when no exact variation
+# matches - high enough to reject different people, low enough to catch
+# typos and transpositions
+_FUZZY_THRESHOLD = 88
 
 class NameMatcher:
-    def __init__(self):
+    def __init__(self, requests_per_second=20):
         self.session = None
+        # Token bucket shaping the aggregate request rate, replacing the old
+        # fixed per-row sleep
+        self.limiter = AsyncLimiter(requests_per_second, 1)
+        # Search results keyed on normalized (first, last) - duplicate names
+        # across the possibilities file skip the network entirely
+        self.response_cache = {}
         self.headers = {
             "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36",
             "accept": "*/*",
@@ -22,42 +84,63 @@ class NameMatcher:
         }
     
     async def __aenter__(self):
-        timeout = aiohttp.ClientTimeout(total=30)
-        self.session = aiohttp.ClientSession(timeout=timeout, headers=self.headers)
+        # Tuned connector (same shape as main-parallel.py): every request
+        # hits legacy.com, so keep-alive + DNS caching means only the first
+        # few connections pay the TLS/DNS setup cost
+        connector = aiohttp.TCPConnector(
+            limit=50,
+            limit_per_host=20,
+            ttl_dns_cache=600,
+            use_dns_cache=True,
+            keepalive_timeout=60,
+            enable_cleanup_closed=True,
+        )
+        timeout = aiohttp.ClientTimeout(total=30, connect=10)
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=timeout,
+            headers=self.headers
+        )
         return self
     
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         if self.session:
             await self.session.close()
     
-    def normalize_name(self, name):
-        """Normalize names for comparison"""
+    @staticmethod
+    @lru_cache(maxsize=65536)
+    def normalize_name(name):
+        """Normalize names for comparison (cached - same names recur across obits)"""
         if not name:
             return ""
-        
-        # Remove accents and normalize unicode
-        name = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').decode('ascii')
+
+        # Remove accents and normalize unicode (skip for pure-ASCII names,
+        # which is the vast majority - isascii() is a cheap C-level scan)
+        if not name.isascii():
+            name = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').decode('ascii')
         
         # Convert to lowercase and strip whitespace
         name = name.lower().strip()
         
-        # Remove common suffixes/prefixes
-        suffixes = ['jr', 'sr', 'ii', 'iii', 'iv', 'v', 'md', 'phd', 'rn', 'np', 'pa']
-        prefixes = ['dr', 'mr', 'mrs', 'ms', 'miss']
-        
-        # Remove periods and split into parts
-        parts = re.split(r'[.\s-]+', name)
-        parts = [p for p in parts if p and p not in suffixes + prefixes]
-        
+        # Remove periods/hyphens, split, and drop common suffixes/prefixes
+        parts = [p for p in _SPLIT_RE.split(name) if p and p not in _STOPWORDS]
+
         return ' '.join(parts)
     
-    def get_name_variations(self, first_name, last_name):
-        """Generate possible name variations for matching"""
+    @staticmethod
+    @lru_cache(maxsize=65536)
+    def get_name_variations(first_name, last_name):
+        """Generate possible name variations for matching.
+
+        Cached and returns a tuple so repeated (first, last) pairs
+        (once per obituary in a result set, plus common surnames across rows)
+        skip the normalization and dedup work entirely.
+        """
         variations = []
-        
+
         # Original names
-        norm_first = self.normalize_name(first_name)
-        norm_last = self.normalize_name(last_name)
+        norm_first = NameMatcher.normalize_name(first_name)
+        norm_last = NameMatcher.normalize_name(last_name)
         
         # Handle hyphenated first names
         if '-' in norm_first:
@@ -93,10 +176,18 @@ class NameMatcher:
             if var not in seen:
                 seen.add(var)
                 unique_variations.append(var)
-        
-        return unique_variations
+
+        return tuple(unique_variations)
     
-    def check_name_match(self, license_first, license_last, obit_name_obj):
+    @staticmethod
+    @lru_cache(maxsize=65536)
+    def phonetic_codes(name):
+        """Metaphone codes for each token of a normalized name"""
+        normalized = NameMatcher.normalize_name(name)
+        return frozenset(jellyfish.metaphone(part) for part in normalized.split() if part)
+
+    @staticmethod
+    def check_name_match(license_first, license_last, obit_name_obj):
         """Check if names match using various strategies"""
         if not obit_name_obj:
             return False, "No name object"
@@ -107,46 +198,56 @@ class NameMatcher:
         obit_nick = obit_name_obj.get('nickName', '')
         obit_maiden = obit_name_obj.get('maidenName', '')
         
+        # Phonetic gate: if the license last name doesn't even sound like the
+        # obit's last or maiden name, skip the variation and fuzzy work - an
+        # O(1) code comparison rejects the vast majority of candidates
+        lic_codes = NameMatcher.phonetic_codes(license_last)
+        obit_codes = NameMatcher.phonetic_codes(obit_last) | NameMatcher.phonetic_codes(obit_maiden)
+        if lic_codes and obit_codes and lic_codes.isdisjoint(obit_codes):
+            return False, f"Phonetic mismatch. License: {license_first} {license_last}, Obit: {obit_first} {obit_last}"
+
         # Get all possible variations of the license name
-        license_variations = self.get_name_variations(license_first, license_last)
-        
-        # Check against primary obit name
-        obit_variations = self.get_name_variations(obit_first, obit_last)
-        
-        # Check for exact matches
-        for lic_first, lic_last in license_variations:
-            for obit_f, obit_l in obit_variations:
-                if lic_first == obit_f and lic_last == obit_l:
-                    return True, f"Exact match: {lic_first} {lic_last}"
-        
-        # Check with middle name as first name
-        if obit_middle:
-            middle_variations = self.get_name_variations(obit_middle, obit_last)
-            for lic_first, lic_last in license_variations:
-                for mid_f, mid_l in middle_variations:
-                    if lic_first == mid_f and lic_last == mid_l:
-                        return True, f"Middle name match: {lic_first} {lic_last}"
-        
-        # Check with nickname
-        if obit_nick:
-            nick_variations = self.get_name_variations(obit_nick, obit_last)
-            for lic_first, lic_last in license_variations:
-                for nick_f, nick_l in nick_variations:
-                    if lic_first == nick_f and lic_last == nick_l:
-                        return True, f"Nickname match: {lic_first} {lic_last}"
-        
-        # Check maiden name
-        if obit_maiden:
-            maiden_variations = self.get_name_variations(obit_first, obit_maiden)
-            for lic_first, lic_last in license_variations:
-                for maiden_f, maiden_l in maiden_variations:
-                    if lic_first == maiden_f and lic_last == maiden_l:
-                        return True, f"Maiden name match: {lic_first} {lic_last}"
-        
+        license_set = frozenset(NameMatcher.get_name_variations(license_first, license_last))
+
+        # Each candidate name source, checked in priority order. Set
+        # intersection replaces the old nested variation loops: O(V) hashing
+        # instead of O(V_lic * V_obit) tuple compares per candidate.
+        candidates = [
+            ("Exact match", obit_first, obit_last),
+            ("Middle name match", obit_middle, obit_last),
+            ("Nickname match", obit_nick, obit_last),
+            ("Maiden name match", obit_first, obit_maiden),
+        ]
+
+        for label, cand_first, cand_last in candidates:
+            if not cand_first or not cand_last:
+                continue
+            matched = license_set & frozenset(NameMatcher.get_name_variations(cand_first, cand_last))
+            if matched:
+                lic_first, lic_last = next(iter(matched))
+                return True, f"{label}: {lic_first} {lic_last}"
+
+        # Fuzzy fallback: the exact ladder misses typos, transpositions and
+        # diminutives ("Bill"/"William"). Score the license name against all
+        # obit name fields at once; token_set_ratio ignores word order and
+        # extra tokens.
+        obit_blob = NameMatcher.normalize_name(
+            ' '.join(n for n in (obit_first, obit_middle, obit_last, obit_nick, obit_maiden) if n))
+        if obit_blob:
+            license_full = f"{NameMatcher.normalize_name(license_first)} {NameMatcher.normalize_name(license_last)}"
+            score = fuzz.token_set_ratio(license_full, obit_blob)
+            if score >= _FUZZY_THRESHOLD:
+                return True, f"Fuzzy match (score={score:.0f}): {license_full}"
+
         return False, f"No match found. License: {license_first} {license_last}, Obit: {obit_first} {obit_last}"
     
     async def get_obituary_details(self, first_name, last_name):
         """Get detailed obituary information including all matches"""
+        cache_key = (self.normalize_name(first_name), self.normalize_name(last_name))
+        cached = self.response_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
         encoded_first = quote(first_name.strip())
         encoded_last = quote(last_name.strip())
         
@@ -165,106 +266,186 @@ class NameMatcher:
         )
         
         try:
-            async with self.session.get(url) as response:
-                if response.status != 200:
-                    return []
-                
-                data = await response.json()
-                return data.get("searchResults", [])
+            async with self.limiter:
+                async with self.session.get(url) as response:
+                    if response.status != 200:
+                        return []
+
+                    data = await response.json(loads=orjson.loads)
+                    results = data.get("searchResults", [])
+                    # Only cache successful responses; errors should stay retryable
+                    self.response_cache[cache_key] = results
+                    return results
         except Exception as e:
-            print(f"Error fetching details for {first_name} {last_name}: {e}")
+            logger.info(f"Error fetching details for {first_name} {last_name}: {e}")
             return []
 
-async def filter_possibilities(input_file, output_filtered, output_removed):
+def match_name_batch(license_first, license_last, name_objs):
+    """Run check_name_match over a batch of obit name dicts.
+
+    Module-level so it pickles into ProcessPoolExecutor workers; sending a
+    whole result set per call amortizes the IPC cost, and each worker
+    process warms its own lru_caches.
+    """
+    return [NameMatcher.check_name_match(license_first, license_last, name_obj)
+            for name_obj in name_objs]
+
+
+def build_name_index(rows):
+    """Index license rows by every normalized name variation.
+
+    Maps each (first, last) variation to the row indices carrying it, so a
+    batch of obituaries can be matched against the entire license list in
+    one pass - O(obituaries + matches) instead of O(rows x obituaries)
+    pairwise checks (or one API call per row). Intended for matching a
+    pre-downloaded obituary dump for a whole date/region window.
+    """
+    index = {}
+    for idx, row in enumerate(rows):
+        first_name = row.get('First Name', '').strip()
+        last_name = row.get('Last Name', '').strip()
+        if not first_name or not last_name:
+            continue
+        for variation in NameMatcher.get_name_variations(first_name, last_name):
+            index.setdefault(variation, []).append(idx)
+    return index
+
+
+def match_obituaries_against_index(index, obituaries):
+    """Stream obituaries through an index built by build_name_index.
+
+    Yields (row_idx, obit, match_reason) per hit, probing the same
+    candidate name sources check_name_match uses pairwise (primary,
+    middle-as-first, nickname, maiden).
+    """
+    for obit in obituaries:
+        name_obj = obit.get('name', {}) or {}
+        obit_first = name_obj.get('firstName', '')
+        obit_last = name_obj.get('lastName', '')
+
+        candidates = [
+            ("Exact match", obit_first, obit_last),
+            ("Middle name match", name_obj.get('middleName', ''), obit_last),
+            ("Nickname match", name_obj.get('nickName', ''), obit_last),
+            ("Maiden name match", obit_first, name_obj.get('maidenName', '')),
+        ]
+
+        seen_rows = set()
+        for label, cand_first, cand_last in candidates:
+            if not cand_first or not cand_last:
+                continue
+            for variation in NameMatcher.get_name_variations(cand_first, cand_last):
+                for row_idx in index.get(variation, ()):
+                    if row_idx not in seen_rows:
+                        seen_rows.add(row_idx)
+                        yield row_idx, obit, f"{label}: {variation[0]} {variation[1]}"
+
+
+async def filter_possibilities(input_file, output_filtered, output_removed, max_concurrent=10):
     """Filter possibilities based on strict name matching"""
-    
-    print(f"Starting name filtering process...")
-    print(f"Input file: {input_file}")
-    print(f"Filtered output: {output_filtered}")
-    print(f"Removed output: {output_removed}")
-    
+
+    logger.info(f"Starting name filtering process...")
+    logger.info(f"Input file: {input_file}")
+    logger.info(f"Filtered output: {output_filtered}")
+    logger.info(f"Removed output: {output_removed}")
+
     if not os.path.exists(input_file):
-        print(f"Error: Input file {input_file} not found!")
+        logger.info(f"Error: Input file {input_file} not found!")
         return
-    
-    filtered_records = []
-    removed_records = []
-    
+
+    # Concurrency cap for in-flight rows; the aggregate request rate is
+    # shaped by the matcher's token bucket
+    semaphore = asyncio.Semaphore(max_concurrent)
+
+    # Matching is pure CPU; run it in worker processes so it doesn't starve
+    # the event loop once responses start arriving concurrently
+    executor = ProcessPoolExecutor(max_workers=os.cpu_count())
+    loop = asyncio.get_running_loop()
+
     async with NameMatcher() as matcher:
         with open(input_file, 'r') as f:
             reader = csv.DictReader(f)
             rows = list(reader)
             fieldnames = reader.fieldnames
-        
-        print(f"Processing {len(rows)} records...")
-        
-        for i, row in enumerate(rows):
+
+        logger.info(f"Processing {len(rows)} records with up to {max_concurrent} concurrent lookups...")
+
+        async def process_row(i, row):
+            """Process one row; returns ('kept'|'removed', record)"""
             first_name = row.get('First Name', '').strip()
             last_name = row.get('Last Name', '').strip()
-            
+
             if not first_name or not last_name:
-                removed_records.append({
+                return 'removed', {
                     **row,
                     'removal_reason': 'Empty name fields',
                     'matched_obituaries': '[]'
-                })
-                continue
-            
-            print(f"Processing {i+1}/{len(rows)}: {first_name} {last_name}")
-            
+                }
+
+            logger.info(f"Processing {i+1}/{len(rows)}: {first_name} {last_name}")
+
             # Get all obituary matches
-            obituaries = await matcher.get_obituary_details(first_name, last_name)
-            
+            async with semaphore:
+                obituaries = await matcher.get_obituary_details(first_name, last_name)
+
             if not obituaries:
-                removed_records.append({
+                return 'removed', {
                     **row,
                     'removal_reason': 'No obituaries found',
                     'matched_obituaries': '[]'
-                })
-                continue
-            
-            # Check each obituary for name matches
+                }
+
+            # Check each obituary for name matches (batched into the pool)
             matched_obituaries = []
             unmatched_obituaries = []
-            
-            for obit in obituaries:
-                name_obj = obit.get('name', {})
-                is_match, match_reason = matcher.check_name_match(first_name, last_name, name_obj)
-                
-                obit_info = {
-                    'name': name_obj,
-                    'id': obit.get('id'),
-                    'obituaryUrl': obit.get('links', {}).get('obituaryUrl', {}).get('href', ''),
-                    'match_reason': match_reason,
-                    'is_match': is_match
-                }
-                
+
+            name_objs = [obit.get('name', {}) for obit in obituaries]
+            outcomes = await loop.run_in_executor(
+                executor, match_name_batch, first_name, last_name, name_objs)
+
+            for obit, name_obj, (is_match, match_reason) in zip(obituaries, name_objs, outcomes):
+                obit_info = ObitInfo(
+                    name=name_obj,
+                    id=obit.get('id'),
+                    obituaryUrl=obit.get('links', {}).get('obituaryUrl', {}).get('href', ''),
+                    match_reason=match_reason,
+                    is_match=is_match,
+                )
+
                 if is_match:
                     matched_obituaries.append(obit_info)
                 else:
                     unmatched_obituaries.append(obit_info)
-            
+
             if matched_obituaries:
                 # Keep record with matched obituaries
-                filtered_records.append({
+                logger.info(f"  ✓ Kept {first_name} {last_name}: {len(matched_obituaries)}/{len(obituaries)} obituaries matched")
+                return 'kept', {
                     **row,
-                    'matched_obituaries': json.dumps(matched_obituaries, indent=2),
+                    # Compact - this column is machine-read downstream
+                    'matched_obituaries': orjson.dumps(matched_obituaries).decode(),
                     'total_matches': len(matched_obituaries),
                     'total_obituaries_found': len(obituaries)
-                })
-                print(f"  ✓ Kept: {len(matched_obituaries)}/{len(obituaries)} obituaries matched")
+                }
             else:
                 # Remove record with unmatched obituaries
-                removed_records.append({
+                logger.info(f"  ✗ Removed {first_name} {last_name}: 0/{len(obituaries)} obituaries matched")
+                return 'removed', {
                     **row,
                     'removal_reason': 'No matching obituary names found',
-                    'matched_obituaries': json.dumps(unmatched_obituaries, indent=2),
+                    # Keep the indent here - removed.csv is what gets eyeballed
+                    'matched_obituaries': orjson.dumps(unmatched_obituaries, option=orjson.OPT_INDENT_2).decode(),
                     'total_obituaries_found': len(obituaries)
-                })
-                print(f"  ✗ Removed: 0/{len(obituaries)} obituaries matched")
-            
-            # Brief delay to be respectful
-            await asyncio.sleep(0.5)
+                }
+
+        try:
+            results = await asyncio.gather(*(process_row(i, row) for i, row in enumerate(rows)))
+        finally:
+            executor.shutdown()
+
+    # Reassemble in input order so output is deterministic
+    filtered_records = [rec for kind, rec in results if kind == 'kept']
+    removed_records = [rec for kind, rec in results if kind == 'removed']
     
     # Write filtered results
     if filtered_records:
@@ -273,9 +454,9 @@ async def filter_possibilities(input_file, output_filtered, output_removed):
             writer = csv.DictWriter(f, fieldnames=filtered_fieldnames)
             writer.writeheader()
             writer.writerows(filtered_records)
-        print(f"✓ Wrote {len(filtered_records)} filtered records to {output_filtered}")
+        logger.info(f"✓ Wrote {len(filtered_records)} filtered records to {output_filtered}")
     else:
-        print("No records passed the filter!")
+        logger.info("No records passed the filter!")
     
     # Write removed results
     if removed_records:
@@ -284,12 +465,12 @@ async def filter_possibilities(input_file, output_filtered, output_removed):
             writer = csv.DictWriter(f, fieldnames=removed_fieldnames)
             writer.writeheader()
             writer.writerows(removed_records)
-        print(f"✓ Wrote {len(removed_records)} removed records to {output_removed}")
+        logger.info(f"✓ Wrote {len(removed_records)} removed records to {output_removed}")
     
-    print(f"\nFiltering complete!")
-    print(f"Kept: {len(filtered_records)}")
-    print(f"Removed: {len(removed_records)}")
-    print(f"Total processed: {len(filtered_records) + len(removed_records)}")
+    logger.info(f"\nFiltering complete!")
+    logger.info(f"Kept: {len(filtered_records)}")
+    logger.info(f"Removed: {len(removed_records)}")
+    logger.info(f"Total processed: {len(filtered_records) + len(removed_records)}")
 
 async def main():
     """Main function"""
@@ -300,4 +481,8 @@ async def main():
     await filter_possibilities(input_file, output_filtered, output_removed)
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    listener = setup_logging()
+    try:
+        asyncio.run(main())
+    finally:
+        listener.stop()
\ No newline at end of file
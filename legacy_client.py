@@ -0,0 +1,288 @@
+"""Shared legacy.com client used by main.py and main-test.py.
+
+One implementation of the search call (sync and async), progress
+checkpointing, and the request constants, so a fix or optimization
+lands once instead of drifting between the two drivers.
+"""
+import asyncio
+import atexit
+import orjson
+import os
+import random
+import re
+import threading
+import time
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import quote
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import aiohttp
+
+# Invariant across requests, so built once instead of per call
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36",
+    "accept": "*/*",
+    "referer": "https://www.legacy.com/obituaries/search",
+    "accept-language": "en-US,en;q=0.9",
+    "accept-encoding": "gzip, deflate, br",
+    "cache-control": "no-cache",
+    "pragma": "no-cache"
+}
+
+URL_TEMPLATE = (
+    "https://www.legacy.com/api/_frontend/search"
+    "?countryIdList=1"
+    "&endDate=12-01-2025"
+    "&firstName={first}"
+    "&keyword="
+    "&lastName={last}"
+    "&limit=50"
+    "&noticeType=all"
+    "&regionIdList=41"
+    "&session_id="
+    "&startDate=01-01-2023"
+)
+
+# Bytes-level probe so the captcha check never decodes the whole body
+CAPTCHA_RE = re.compile(rb'captcha', re.IGNORECASE)
+
+# One pooled session so sequential sync requests reuse the TCP/TLS
+# connection instead of paying the handshake on every call. Retries stay
+# in search_legacy_obituary, which wants per-status handling.
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4, pool_maxsize=10,
+    max_retries=Retry(total=0, backoff_factor=0, status_forcelist=[])))
+atexit.register(SESSION.close)
+
+
+def rate_limit_wait(retry_after, attempt, base=60):
+    """How long to sleep after a 429, honoring Retry-After when sane.
+
+    Falls back to exponential backoff, adds up to 10% jitter so resumed
+    workers don't retry in lockstep, and clamps at 10 minutes so a
+    misconfigured server can't stall the job for hours.
+    """
+    if retry_after and retry_after.isdigit():
+        wait_time = int(retry_after)
+    else:
+        wait_time = (2 ** attempt) * base
+    wait_time += random.uniform(0, wait_time * 0.1)
+    return min(wait_time, 600)
+
+
+def build_search_url(first_name, last_name):
+    """URL encode the names to handle special characters"""
+    return URL_TEMPLATE.format(first=quote(first_name.strip()),
+                               last=quote(last_name.strip()))
+
+
+def search_legacy_obituary(first_name, last_name, max_retries=3, force_fail_at=None):
+    """
+    Search for obituary with exponential backoff retry logic
+    """
+    # Test hook: force failure at a specific index
+    if force_fail_at is not None:
+        raise Exception(f"Forced failure for testing at index {force_fail_at}")
+
+    url = build_search_url(first_name, last_name)
+
+    for attempt in range(max_retries):
+        try:
+            response = SESSION.get(url, timeout=30)
+
+            # Check for rate limiting or captcha
+            if response.status_code == 429:
+                print(f"Rate limited (429) on attempt {attempt + 1}")
+                if attempt < max_retries - 1:
+                    wait_time = rate_limit_wait(
+                        response.headers.get('Retry-After'), attempt)
+                    print(f"Waiting {wait_time:.0f} seconds before retry...")
+                    time.sleep(wait_time)
+                    continue
+                else:
+                    raise Exception("Rate limited - max retries exceeded")
+
+            if response.status_code == 403:
+                print("Blocked (403) - possible IP ban or captcha")
+                raise Exception("Blocked by server")
+
+            body = response.content
+
+            if CAPTCHA_RE.search(body):
+                print("Captcha detected")
+                raise Exception("Captcha required")
+
+            if response.status_code != 200:
+                # Decode only the logged slice, not the whole (possibly huge) body
+                snippet = body[:100].decode('utf-8', errors='replace')
+                print(f"HTTP {response.status_code}: {snippet}")
+                if attempt < max_retries - 1:
+                    time.sleep(5)
+                    continue
+                else:
+                    return False  # Assume no match on persistent errors
+
+            data = orjson.loads(body)
+            return data.get("totalRecordCount", 0) > 0
+
+        except requests.exceptions.RequestException as e:
+            print(f"Request error on attempt {attempt + 1}: {e}")
+            if attempt < max_retries - 1:
+                time.sleep(5)
+                continue
+            else:
+                return False  # Assume no match on persistent connection errors
+
+    return False
+
+
+async def search_legacy_obituary_async(session, first_name, last_name, sem,
+                                       max_retries=3, limiter=None):
+    """
+    Search for obituary with exponential backoff retry logic.
+
+    limiter, when given, is told about throttling (429/403) and
+    successes so an adaptive controller can adjust the request rate.
+    """
+    url = build_search_url(first_name, last_name)
+
+    async with sem:  # Bound the number of in-flight requests
+        for attempt in range(max_retries):
+            try:
+                async with session.get(url) as response:
+                    # Check for rate limiting or captcha
+                    if response.status == 429:
+                        print(f"Rate limited (429) on attempt {attempt + 1}")
+                        if limiter is not None:
+                            limiter.record_throttle()
+                        if attempt < max_retries - 1:
+                            wait_time = rate_limit_wait(
+                                response.headers.get('Retry-After'), attempt)
+                            print(f"Waiting {wait_time:.0f} seconds before retry...")
+                            await asyncio.sleep(wait_time)
+                            continue
+                        else:
+                            raise Exception("Rate limited - max retries exceeded")
+
+                    if response.status == 403:
+                        print("Blocked (403) - possible IP ban or captcha")
+                        if limiter is not None:
+                            limiter.record_throttle()
+                        raise Exception("Blocked by server")
+
+                    body = await response.read()
+
+                    if CAPTCHA_RE.search(body):
+                        print("Captcha detected")
+                        raise Exception("Captcha required")
+
+                    if response.status != 200:
+                        snippet = body[:100].decode('utf-8', errors='replace')
+                        print(f"HTTP {response.status}: {snippet}")
+                        if attempt < max_retries - 1:
+                            await asyncio.sleep(5)
+                            continue
+                        else:
+                            return False  # Assume no match on persistent errors
+
+                    data = orjson.loads(body)
+                    if limiter is not None:
+                        limiter.record_success()
+                    return data.get("totalRecordCount", 0) > 0
+
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print(f"Request error on attempt {attempt + 1}: {e}")
+                if attempt < max_retries - 1:
+                    await asyncio.sleep(5)
+                    continue
+                else:
+                    return False  # Assume no match on persistent connection errors
+
+    return False
+
+
+class OffsetTrackingLines:
+    """Line iterator over a text file that keeps byte offsets usable.
+
+    Iterating a text file directly disables tell(), so this reads via
+    readline() and records the offset after each line. csv readers accept
+    any line iterator, and .offset after a row is the start of the next.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.offset = file.tell()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.file.readline()
+        if not line:
+            raise StopIteration
+        self.offset = self.file.tell()
+        return line
+
+    def seek(self, offset):
+        self.file.seek(offset)
+        self.offset = offset
+
+
+def _progress_path(file_path):
+    return f"{os.path.splitext(os.path.basename(file_path))[0]}_progress.json"
+
+
+# Checkpoints are written off the caller's thread by a single background
+# worker; queued-up saves for the same file coalesce to the newest state.
+_progress_executor = ThreadPoolExecutor(max_workers=1)
+_pending_progress = {}
+_pending_lock = threading.Lock()
+atexit.register(_progress_executor.shutdown, wait=True)
+
+
+def _flush_progress(file_path):
+    with _pending_lock:
+        progress_data = _pending_progress.pop(file_path, None)
+    if progress_data is None:
+        return  # Already written by a newer queued flush
+
+    progress_file = _progress_path(file_path)
+    # Write-then-rename so a crash mid-write can't corrupt the checkpoint
+    tmp_file = progress_file + '.tmp'
+    with open(tmp_file, 'wb') as pf:
+        pf.write(orjson.dumps(progress_data))
+    os.replace(tmp_file, progress_file)
+
+
+def save_progress(file_path, idx, additional_data=None):
+    """Save progress with additional metadata"""
+    progress_data = {
+        "last_processed_index": idx,
+        "timestamp": datetime.now().isoformat(),
+        "file_path": file_path
+    }
+    if additional_data:
+        progress_data.update(additional_data)
+
+    with _pending_lock:
+        _pending_progress[file_path] = progress_data
+    _progress_executor.submit(_flush_progress, file_path)
+
+
+def load_progress_data(file_path):
+    """Load the full saved progress dict, or {} if there is none"""
+    try:
+        with open(_progress_path(file_path), 'rb') as pf:
+            return orjson.loads(pf.read())
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        return {}
+
+
+def load_progress(file_path):
+    """Load progress from file"""
+    return load_progress_data(file_path).get("last_processed_index", 0)
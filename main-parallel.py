@@ -1,29 +1,67 @@
+import argparse
 import csv
 import aiohttp
 import asyncio
+import io
 import time
-import random
+import logging
+import logging.handlers
+import queue
+import re
+from aiolimiter import AsyncLimiter
 from datetime import datetime
 import sys
 import os
 import json
+import orjson
 from urllib.parse import quote
 import aiofiles
+import pandas as pd
+
+from legacy_client import rate_limit_wait
+
+
+logger = logging.getLogger(__name__)
+
+# Bytes-level probe so the captcha check never decodes the whole body
+CAPTCHA_RE = re.compile(rb'captcha', re.IGNORECASE)
+
+
+def setup_logging():
+    """Route log records through a queue drained by a background thread.
+
+    print() takes the GIL and a stdout write syscall per line; under
+    high concurrency that serializes tasks on the terminal. Returns the
+    listener so the caller can stop it (flushing the queue) on exit.
+    """
+    log_queue = queue.Queue(-1)
+    logging.basicConfig(level=logging.INFO, format="%(message)s",
+                        handlers=[logging.handlers.QueueHandler(log_queue)])
+    listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
+    listener.start()
+    return listener
+
 
 class AsyncObituarySearcher:
-    def __init__(self, max_concurrent=10, delay_range=(0.5, 1.5), max_retries=3):
+    def __init__(self, max_concurrent=10, requests_per_second=10, max_retries=3):
         self.max_concurrent = max_concurrent
-        self.delay_range = delay_range
         self.max_retries = max_retries
         self.session = None
         self.semaphore = asyncio.Semaphore(max_concurrent)
-        self.rate_limiter = asyncio.Semaphore(max_concurrent)  # Additional rate limiting
+        # Token bucket shaping the aggregate request rate; unlike the old
+        # per-task random sleep it doesn't hold a concurrency slot while idle
+        self.limiter = AsyncLimiter(requests_per_second, 1)
         
         # Progress tracking
         self.total_found = 0
         self.total_processed = 0
         self.results = []
         self.lock = asyncio.Lock()  # For thread-safe operations
+
+        # Duplicate (first, last) pairs recur across and within license
+        # lists; cache the search outcome so each unique name costs one
+        # network call per run
+        self.response_cache = {}
         
         # Headers for requests
         self.headers = {
@@ -57,110 +95,102 @@ class AsyncObituarySearcher:
         if self.session:
             await self.session.close()
 
+    async def _record_result(self, found, first_name, last_name, row_data):
+        """Thread-safe progress tracking"""
+        async with self.lock:
+            self.total_processed += 1
+            if found:
+                self.total_found += 1
+                self.results.append(row_data)
+                logger.info(f"✓ FOUND: {first_name} {last_name} ({self.total_found}/{self.total_processed})")
+            else:
+                logger.info(f"✗ Not found: {first_name} {last_name} ({self.total_found}/{self.total_processed})")
+
     async def search_legacy_obituary(self, first_name, last_name, row_data):
         """
         Search for obituary with semaphore-based rate limiting
         """
+        # Duplicate name? Reuse the previous outcome instead of re-querying
+        cache_key = (first_name.strip().lower(), last_name.strip().lower())
+        cached = self.response_cache.get(cache_key)
+        if cached is not None:
+            await self._record_result(cached, first_name, last_name, row_data)
+            return cached, row_data
+
         async with self.semaphore:  # Limit concurrent requests
-            async with self.rate_limiter:  # Additional rate limiting
-                # URL encode the names to handle special characters
-                encoded_first = quote(first_name.strip())
-                encoded_last = quote(last_name.strip())
+            # URL encode the names to handle special characters
+            encoded_first = quote(first_name.strip())
+            encoded_last = quote(last_name.strip())
                 
-                url = (
-                    "https://www.legacy.com/api/_frontend/search"
-                    "?countryIdList=1"
-                    "&endDate=12-01-2025"
-                    f"&firstName={encoded_first}"
-                    "&keyword="
-                    f"&lastName={encoded_last}"
-                    "&limit=50"
-                    "&noticeType=all"
-                    "&regionIdList=41"
-                    "&session_id="
-                    "&startDate=01-01-2023"
-                )
-                
-                # Add random delay to spread out requests
-                delay = random.uniform(*self.delay_range)
-                await asyncio.sleep(delay)
+            url = (
+                "https://www.legacy.com/api/_frontend/search"
+                "?countryIdList=1"
+                "&endDate=12-01-2025"
+                f"&firstName={encoded_first}"
+                "&keyword="
+                f"&lastName={encoded_last}"
+                "&limit=50"
+                "&noticeType=all"
+                "&regionIdList=41"
+                "&session_id="
+                "&startDate=01-01-2023"
+            )
                 
-                for attempt in range(self.max_retries):
-                    try:
-                        async with self.session.get(url) as response:
-                            # Handle rate limiting
-                            if response.status == 429:
-                                wait_time = (2 ** attempt) * 30  # Exponential backoff
-                                print(f"Rate limited (429) for {first_name} {last_name}, waiting {wait_time}s")
-                                await asyncio.sleep(wait_time)
-                                continue
-                            
-                            if response.status == 403:
-                                print(f"Blocked (403) for {first_name} {last_name}")
-                                return False, row_data
+            for attempt in range(self.max_retries):
+                try:
+                    # Wait for a token (time-based, released automatically)
+                    await self.limiter.acquire()
+                    async with self.session.get(url) as response:
+                        # Handle rate limiting
+                        if response.status == 429:
+                            wait_time = rate_limit_wait(
+                                response.headers.get('Retry-After'), attempt, base=30)
+                            logger.info(f"Rate limited (429) for {first_name} {last_name}, waiting {wait_time:.0f}s")
+                            await asyncio.sleep(wait_time)
+                            continue
                             
-                            response_text = await response.text()
+                        if response.status == 403:
+                            logger.info(f"Blocked (403) for {first_name} {last_name}")
+                            return False, row_data
                             
-                            if "captcha" in response_text.lower():
-                                print(f"Captcha detected for {first_name} {last_name}")
+                        body = await response.read()
+
+                        if CAPTCHA_RE.search(body):
+                            logger.info(f"Captcha detected for {first_name} {last_name}")
+                            return False, row_data
+
+                        if response.status != 200:
+                            logger.info(f"HTTP {response.status} for {first_name} {last_name}")
+                            if attempt < self.max_retries - 1:
+                                await asyncio.sleep(5)
+                                continue
+                            else:
                                 return False, row_data
+
+                        data = orjson.loads(body)
+                        found = data.get("totalRecordCount", 0) > 0
+
+                        self.response_cache[cache_key] = found
+                        await self._record_result(found, first_name, last_name, row_data)
+
+                        return found, row_data
                             
-                            if response.status != 200:
-                                print(f"HTTP {response.status} for {first_name} {last_name}")
-                                if attempt < self.max_retries - 1:
-                                    await asyncio.sleep(5)
-                                    continue
-                                else:
-                                    return False, row_data
-                            
-                            data = await response.json()
-                            found = data.get("totalRecordCount", 0) > 0
-                            
-                            # Thread-safe progress tracking
-                            async with self.lock:
-                                self.total_processed += 1
-                                if found:
-                                    self.total_found += 1
-                                    self.results.append(row_data)
-                                    print(f"✓ FOUND: {first_name} {last_name} ({self.total_found}/{self.total_processed})")
-                                else:
-                                    print(f"✗ Not found: {first_name} {last_name} ({self.total_found}/{self.total_processed})")
-                            
-                            return found, row_data
-                            
-                    except aiohttp.ClientError as e:
-                        print(f"Request error for {first_name} {last_name} (attempt {attempt + 1}): {e}")
-                        if attempt < self.max_retries - 1:
-                            await asyncio.sleep(5)
-                            continue
-                        else:
-                            return False, row_data
-                    except asyncio.TimeoutError:
-                        print(f"Timeout for {first_name} {last_name} (attempt {attempt + 1})")
-                        if attempt < self.max_retries - 1:
-                            await asyncio.sleep(5)
-                            continue
-                        else:
-                            return False, row_data
+                except aiohttp.ClientError as e:
+                    logger.info(f"Request error for {first_name} {last_name} (attempt {attempt + 1}): {e}")
+                    if attempt < self.max_retries - 1:
+                        await asyncio.sleep(5)
+                        continue
+                    else:
+                        return False, row_data
+                except asyncio.TimeoutError:
+                    logger.info(f"Timeout for {first_name} {last_name} (attempt {attempt + 1})")
+                    if attempt < self.max_retries - 1:
+                        await asyncio.sleep(5)
+                        continue
+                    else:
+                        return False, row_data
                 
-                return False, row_data
-
-    async def process_batch(self, batch_data):
-        """Process a batch of records concurrently"""
-        tasks = []
-        for idx, row in batch_data:
-            first_name = row.get('First Name', '').strip()
-            last_name = row.get('Last Name', '').strip()
-            
-            # Skip if names are empty or too short
-            if not first_name or not last_name or len(first_name) < 2 or len(last_name) < 2:
-                continue
-            
-            task = self.search_legacy_obituary(first_name, last_name, row)
-            tasks.append(task)
-        
-        if tasks:
-            await asyncio.gather(*tasks, return_exceptions=True)
+            return False, row_data
 
 def save_progress(file_path, idx, additional_data=None):
     """Save progress with additional metadata"""
@@ -172,9 +202,12 @@ def save_progress(file_path, idx, additional_data=None):
     }
     if additional_data:
         progress_data.update(additional_data)
-    
-    with open(progress_file, 'w') as pf:
-        json.dump(progress_data, pf, indent=2)
+
+    # Write-then-rename so a crash mid-write can't corrupt the checkpoint
+    tmp_file = progress_file + '.tmp'
+    with open(tmp_file, 'wb') as pf:
+        pf.write(orjson.dumps(progress_data))
+    os.replace(tmp_file, progress_file)
 
 def load_progress(file_path):
     """Load progress from file"""
@@ -186,114 +219,190 @@ def load_progress(file_path):
     except (FileNotFoundError, json.JSONDecodeError):
         return 0
 
+# Trailing year of an expiration date in any of the formats seen in the
+# license files (mm/dd/yyyy, mm-dd-yy, ...) - one scan, no split allocations
+_YEAR_RE = re.compile(r'(\d{2,4})\s*$')
+
+
 def filter_valid_rows(rows):
-    """Filter rows with valid expiration dates (2024+)"""
-    valid_rows = []
+    """Yield (idx, row) pairs with valid expiration dates (2024+)"""
     for idx, row in enumerate(rows):
         # Skip rows with invalid expiration dates
-        exp_date = row.get('Expiration Date', '').strip()
-        if not exp_date:
-            continue
-            
-        try:
-            # Handle different date formats
-            if '/' in exp_date:
-                year = int(exp_date.split('/')[-1])
-            elif '-' in exp_date:
-                year = int(exp_date.split('-')[-1])
-            else:
-                continue
-        except (ValueError, IndexError):
+        exp_date = row.get('Expiration Date', '')
+        match = _YEAR_RE.search(exp_date)
+        if not match:
             continue
-            
+
+        year = int(match.group(1))
+        if year < 100:  # Two-digit years
+            year += 2000
+
         # Only process recent expirations (likely deaths)
         if year <= 2023:
             continue
-            
-        valid_rows.append((idx, row))
-    
-    return valid_rows
 
-async def process_licenses_async(file_path, output_file, batch_size=50, max_concurrent=10):
+        yield idx, row
+
+
+_CSV_CHUNK_ROWS = 4096
+
+
+def read_candidate_rows(file_path, start_idx=0):
+    """Yield (idx, row) candidates using pandas' C parser.
+
+    Same filter as filter_valid_rows (which stays for plain-iterable
+    callers), but the per-row Python work moves into vectorized column
+    operations. Chunked reading keeps peak memory bounded, matching the
+    streaming pipeline.
     """
-    Process license file asynchronously with batching
+    for chunk in pd.read_csv(file_path, dtype=str, keep_default_na=False,
+                             chunksize=_CSV_CHUNK_ROWS):
+        # Chunk index continues the global row numbering across chunks
+        if start_idx and chunk.index[-1] < start_idx:
+            continue
+
+        years = pd.to_numeric(
+            chunk['Expiration Date'].str.extract(_YEAR_RE, expand=False),
+            errors='coerce')
+        years = years.where(years >= 100, years + 2000)  # Two-digit years
+
+        mask = years > 2023
+        if start_idx:
+            mask &= chunk.index >= start_idx
+
+        selected = chunk.loc[mask]
+        for idx, row in zip(selected.index, selected.to_dict('records')):
+            yield int(idx), row
+
+async def process_licenses_async(file_path, output_file, batch_size=50, max_concurrent=10, file_mode='a'):
+    """
+    Process license file with a streaming producer/consumer pipeline.
+
+    file_mode comes from the CLI (--append/--overwrite); prompting here
+    would block the event loop on stdin.
+
+    A single producer reads the CSV row by row and feeds a bounded queue;
+    max_concurrent workers consume it. Peak memory stays at O(concurrency)
+    instead of O(rows), and the first request goes out as soon as the first
+    valid row is read rather than after the whole file is parsed.
     """
     start_idx = load_progress(file_path)
-    
-    print(f"Starting async processing of {file_path}")
-    print(f"Max concurrent requests: {max_concurrent}")
-    print(f"Batch size: {batch_size}")
-    print(f"Resuming from index: {start_idx}")
-    
-    # Read all rows
+
+    logger.info(f"Starting async processing of {file_path}")
+    logger.info(f"Max concurrent requests: {max_concurrent}")
+    logger.info(f"Checkpoint every: {batch_size} processed rows")
+    logger.info(f"Resuming from index: {start_idx}")
+
+    # Read just the header so the result writer is ready before any row lands
     with open(file_path, mode='r') as file:
-        reader = csv.DictReader(file)
-        all_rows = list(reader)
-        fieldnames = reader.fieldnames
-    
-    # Filter valid rows and skip already processed ones
-    valid_rows = filter_valid_rows(all_rows)
-    valid_rows = [(idx, row) for idx, row in valid_rows if idx >= start_idx]
-    
-    print(f"Total valid rows to process: {len(valid_rows)}")
-    
-    if not valid_rows:
-        print("No valid rows to process!")
-        return
-    
-    # Process in batches
+        fieldnames = csv.DictReader(file).fieldnames
+
+    queue = asyncio.Queue(maxsize=max_concurrent * 4)
+    highest_idx = start_idx
+    in_flight = set()  # Indices queued or being searched, not yet finished
+
+    # Write the header when creating/truncating, or when appending to a file
+    # that does not exist yet
+    need_header = (file_mode == 'w'
+                   or not os.path.exists(output_file)
+                   or os.path.getsize(output_file) == 0)
+
     async with AsyncObituarySearcher(max_concurrent=max_concurrent) as searcher:
-        # Check if we should append to existing file
-        # file_mode = 'w'
-        # if os.path.exists(output_file):
-        #     response = input(f"{output_file} already exists. Append to it? (y/n): ")
-        #     if response.lower() == 'y':
-        #         file_mode = 'a'
-        
-        file_mode = 'a'
+        # One long-lived async handle; a sync open() per flush would block the
+        # event loop (and every in-flight request) on disk latency
+        out_fh = await aiofiles.open(output_file, mode=file_mode, newline='')
 
-        # Process all batches
-        for i in range(0, len(valid_rows), batch_size):
-            batch = valid_rows[i:i + batch_size]
-            last_idx = batch[-1][0]
-            
-            print(f"\nProcessing batch {i//batch_size + 1}/{(len(valid_rows) + batch_size - 1)//batch_size}")
-            print(f"Batch range: {batch[0][0]} to {last_idx}")
-            
-            batch_start_time = time.time()
-            await searcher.process_batch(batch)
-            batch_time = time.time() - batch_start_time
-            
-            print(f"Batch completed in {batch_time:.1f}s")
-            print(f"Total found so far: {searcher.total_found}/{searcher.total_processed}")
-            
-            # Save progress and results after each batch
-            save_progress(file_path, last_idx, {
-                "total_found": searcher.total_found,
-                "total_processed": searcher.total_processed
-            })
-            
-            # Write results to file
-            if searcher.results:
-                with open(output_file, file_mode, newline='') as out_csv:
-                    writer = csv.DictWriter(out_csv, fieldnames=fieldnames)
-                    if file_mode == 'w':
-                        writer.writeheader()
-                        file_mode = 'a'  # Switch to append mode after first write
-                    
-                    for result in searcher.results:
-                        writer.writerow(result)
-                
-                # Clear results after writing to avoid duplicates
-                searcher.results.clear()
-            
-            # Brief pause between batches to be respectful
-            await asyncio.sleep(2)
-    
-    print(f"\nCompleted {file_path}")
-    print(f"Final results: {searcher.total_found}/{searcher.total_processed}")
+        def format_rows(batch, header=False):
+            """Render rows to a CSV string via an in-memory buffer"""
+            buffer = io.StringIO()
+            writer = csv.DictWriter(buffer, fieldnames=fieldnames)
+            if header:
+                writer.writeheader()
+            writer.writerows(batch)
+            return buffer.getvalue()
+
+        flush_lock = asyncio.Lock()
+
+        async def flush(final=False):
+            """Write accumulated results and checkpoint progress"""
+            nonlocal need_header
+            async with flush_lock:  # Checkpoints can race; writes must not interleave
+                async with searcher.lock:
+                    batch, searcher.results = searcher.results, []
+                    found, processed = searcher.total_found, searcher.total_processed
+
+                if batch or need_header:
+                    header = need_header
+                    need_header = False
+                    await out_fh.write(format_rows(batch, header=header))
+                    await out_fh.flush()
+
+            extra = {"total_found": found, "total_processed": processed}
+            if final:
+                extra["completed"] = True
+            # Workers finish out of order, so checkpoint the oldest row still
+            # queued or in flight - never an index past an incomplete row
+            checkpoint_idx = min(in_flight) if in_flight else highest_idx
+            save_progress(file_path, checkpoint_idx, extra)
+            return checkpoint_idx
+
+        async def producer():
+            """Stream valid rows into the queue, then signal workers to stop"""
+            for idx, row in read_candidate_rows(file_path, start_idx):
+                in_flight.add(idx)
+                await queue.put((idx, row))
 
-async def main():
+            for _ in range(max_concurrent):
+                await queue.put(None)
+
+        async def worker():
+            nonlocal highest_idx
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+                idx, row = item
+
+                first_name = row.get('First Name', '').strip()
+                last_name = row.get('Last Name', '').strip()
+
+                # Skip if names are empty or too short
+                if not first_name or not last_name or len(first_name) < 2 or len(last_name) < 2:
+                    in_flight.discard(idx)
+                    continue
+
+                await searcher.search_legacy_obituary(first_name, last_name, row)
+                in_flight.discard(idx)
+                highest_idx = max(highest_idx, idx)
+
+                if searcher.total_processed % batch_size == 0:
+                    checkpoint_idx = await flush()
+                    logger.info(f"Checkpoint at index {checkpoint_idx}: {searcher.total_found}/{searcher.total_processed} found")
+
+        start_time = time.time()
+        try:
+            await asyncio.gather(producer(), *(worker() for _ in range(max_concurrent)))
+            await flush(final=True)
+        finally:
+            await out_fh.close()
+        elapsed = time.time() - start_time
+
+    logger.info(f"\nCompleted {file_path} in {elapsed:.1f}s")
+    logger.info(f"Final results: {searcher.total_found}/{searcher.total_processed}")
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Search legacy.com for obituaries matching license rows")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--append', dest='file_mode', action='store_const',
+                      const='a', help="Append to the output file (default)")
+    mode.add_argument('--overwrite', dest='file_mode', action='store_const',
+                      const='w', help="Truncate the output file first")
+    parser.set_defaults(file_mode='a')
+    return parser.parse_args()
+
+
+async def main(file_mode='a'):
     """Main execution function"""
     nursing_file = './nursing-licenses.csv'
     physician_file = './physician-licenses.csv'
@@ -314,30 +423,37 @@ async def main():
         output_file = f"possibilities-{timestamp}.csv"
     
     for file_path in files_to_process:
-        print(f"\n{'='*50}")
-        print(f"Processing: {file_path}")
-        print(f"{'='*50}")
+        logger.info(f"\n{'='*50}")
+        logger.info(f"Processing: {file_path}")
+        logger.info(f"{'='*50}")
         
         if not os.path.exists(file_path):
-            print(f"Warning: File {file_path} not found. Skipping.")
+            logger.info(f"Warning: File {file_path} not found. Skipping.")
             continue
         
         try:
             await process_licenses_async(
-                file_path, 
-                output_file, 
+                file_path,
+                output_file,
                 batch_size=BATCH_SIZE,
-                max_concurrent=MAX_CONCURRENT
+                max_concurrent=MAX_CONCURRENT,
+                file_mode=file_mode
             )
-            print(f"Successfully completed {file_path}")
+            file_mode = 'a'  # Never truncate between input files
+            logger.info(f"Successfully completed {file_path}")
         except Exception as e:
-            print(f"Error processing {file_path}: {e}")
+            logger.info(f"Error processing {file_path}: {e}")
             break
     
-    print("\nAll processing complete!")
+    logger.info("\nAll processing complete!")
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    args = parse_args()
+    listener = setup_logging()
+    try:
+        asyncio.run(main(file_mode=args.file_mode))
+    finally:
+        listener.stop()
 
 
 
@@ -1,127 +1,25 @@
 import csv
-import requests
+import itertools
+import re
 import time
 import random
-from datetime import datetime
-import sys
 import os
 import json
-from urllib.parse import quote
 
-def search_legacy_obituary(first_name, last_name, max_retries=3, force_fail_at=None):
-    """
-    Search for obituary with ability to force failure for testing
-    """
-    # For testing: force failure at specific index
-    if force_fail_at is not None:
-        raise Exception(f"Forced failure for testing at index {force_fail_at}")
-    
-    # URL encode the names to handle special characters
-    encoded_first = quote(first_name.strip())
-    encoded_last = quote(last_name.strip())
-    
-    url = (
-        "https://www.legacy.com/api/_frontend/search"
-        "?countryIdList=1"
-        "&endDate=12-01-2025"
-        f"&firstName={encoded_first}"
-        "&keyword="
-        f"&lastName={encoded_last}"
-        "&limit=50"
-        "&noticeType=all"
-        "&regionIdList=41"
-        "&session_id="
-        "&startDate=01-01-2023"
-    )
-    
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36",
-        "accept": "*/*",
-        "referer": "https://www.legacy.com/obituaries/search",
-        "accept-language": "en-US,en;q=0.9",
-        "accept-encoding": "gzip, deflate, br",
-        "cache-control": "no-cache",
-        "pragma": "no-cache"
-    }
-    
-    for attempt in range(max_retries):
-        try:
-            response = requests.get(url, headers=headers, timeout=30)
-            
-            # Check for rate limiting or captcha
-            if response.status_code == 429:
-                print(f"Rate limited (429) on attempt {attempt + 1}")
-                if attempt < max_retries - 1:
-                    wait_time = (2 ** attempt) * 60  # Exponential backoff: 1, 2, 4 minutes
-                    print(f"Waiting {wait_time} seconds before retry...")
-                    time.sleep(wait_time)
-                    continue
-                else:
-                    raise Exception("Rate limited - max retries exceeded")
-            
-            if response.status_code == 403:
-                print("Blocked (403) - possible IP ban or captcha")
-                raise Exception("Blocked by server")
-            
-            if "captcha" in response.text.lower():
-                print("Captcha detected")
-                raise Exception("Captcha required")
-            
-            if response.status_code != 200:
-                print(f"HTTP {response.status_code}: {response.text[:100]}")
-                if attempt < max_retries - 1:
-                    time.sleep(5)
-                    continue
-                else:
-                    return False  # Assume no match on persistent errors
-            
-            data = response.json()
-            return data.get("totalRecordCount", 0) > 0
-            
-        except requests.exceptions.RequestException as e:
-            print(f"Request error on attempt {attempt + 1}: {e}")
-            if attempt < max_retries - 1:
-                time.sleep(5)
-                continue
-            else:
-                return False  # Assume no match on persistent connection errors
-    
-    return False
-
-def save_progress(file_path, idx, additional_data=None):
-    """Save progress with additional metadata"""
-    progress_file = f"{os.path.splitext(os.path.basename(file_path))[0]}_progress.json"
-    progress_data = {
-        "last_processed_index": idx,
-        "timestamp": datetime.now().isoformat(),
-        "file_path": file_path
-    }
-    if additional_data:
-        progress_data.update(additional_data)
-    
-    with open(progress_file, 'w') as pf:
-        json.dump(progress_data, pf, indent=2)
-    
-    print(f"Progress saved to {progress_file}: index {idx}")
+from legacy_client import (OffsetTrackingLines, search_legacy_obituary,
+                           save_progress, load_progress_data)
 
-def load_progress(file_path):
-    """Load progress from file"""
-    progress_file = f"{os.path.splitext(os.path.basename(file_path))[0]}_progress.json"
-    try:
-        with open(progress_file, 'r') as pf:
-            data = json.load(pf)
-            start_idx = data.get("last_processed_index", 0)
-            print(f"Progress loaded from {progress_file}: resuming from index {start_idx}")
-            return start_idx
-    except (FileNotFoundError, json.JSONDecodeError):
-        print(f"No progress file found for {file_path}, starting from beginning")
-        return 0
+# Matches the 4-digit year at the end of "MM/DD/YYYY" or "MM-YYYY" style dates
+YEAR_RE = re.compile(r'[-/](\d{4})\s*$')
 
 def test_mode_process_licenses(file_path, writer, output_file, delay_range=(2, 4), fail_at_index=None, max_entries=None):
     """
     Test version with shorter delays and optional forced failure
     """
-    start_idx = load_progress(file_path)
+    progress = load_progress_data(file_path)
+    start_idx = progress.get("last_processed_index", 0)
+    byte_offset = progress.get("byte_offset")
+    saved_fieldnames = progress.get("fieldnames")
     total_found = 0
     total_processed = 0
     
@@ -132,11 +30,35 @@ def test_mode_process_licenses(file_path, writer, output_file, delay_range=(2, 4
     if max_entries:
         print(f"Will process max {max_entries} entries")
     
+    # Cheap line count for the progress messages; rows themselves are streamed
     with open(file_path, mode='r') as file:
-        reader = csv.DictReader(file)
-        rows = list(reader)
-        total_rows = len(rows)
-        
+        total_rows = max(sum(1 for _ in file) - 1, 0)
+
+    with open(file_path, mode='r', newline='') as file:
+        lines = OffsetTrackingLines(file)
+        if byte_offset and saved_fieldnames:
+            # Seek straight to the saved row instead of re-parsing 0..start_idx
+            lines.seek(byte_offset)
+            reader = csv.reader(lines)
+            fieldnames = saved_fieldnames
+        else:
+            reader = csv.reader(lines)
+            fieldnames = next(reader, [])
+            for _ in itertools.islice(reader, start_idx):
+                pass  # Old-format progress file: skip by parsing
+        row_iter = enumerate(reader, start=start_idx)
+
+        # Column positions never change; resolve them once instead of three
+        # dict lookups per row (csv.reader also skips DictReader's per-row dict)
+        try:
+            exp_i = fieldnames.index('Expiration Date')
+            fn_i = fieldnames.index('First Name')
+            ln_i = fieldnames.index('Last Name')
+        except ValueError:
+            print(f"❌ Missing expected columns in {file_path}")
+            return False
+        needed_cols = max(exp_i, fn_i, ln_i) + 1
+
         # Limit entries for testing
         if max_entries and start_idx + max_entries < total_rows:
             end_idx = start_idx + max_entries
@@ -144,37 +66,34 @@ def test_mode_process_licenses(file_path, writer, output_file, delay_range=(2, 4
         else:
             end_idx = total_rows
             print(f"Processing entries {start_idx} to {total_rows}")
-        
-        for idx, row in enumerate(rows):
-            if idx < start_idx:
-                continue
-                
+
+        next_row_offset = lines.offset
+        for idx, row in row_iter:
+            # Offsets: this row starts where the previous one ended
+            row_offset, next_row_offset = next_row_offset, lines.offset
             if idx >= end_idx:
                 print(f"Reached max entries limit ({max_entries})")
                 break
                 
-            # Skip rows with invalid expiration dates
-            exp_date = row.get('Expiration Date', '').strip()
+            # Skip short rows and rows with invalid expiration dates
+            if len(row) < needed_cols:
+                continue
+            exp_date = row[exp_i].strip()
             if not exp_date:
                 continue
                 
-            try:
-                # Handle different date formats
-                if '/' in exp_date:
-                    year = int(exp_date.split('/')[-1])
-                elif '-' in exp_date:
-                    year = int(exp_date.split('-')[-1])
-                else:
-                    continue
-            except (ValueError, IndexError):
+            # Handle different date formats without allocating a split list
+            year_match = YEAR_RE.search(exp_date)
+            if not year_match:
                 continue
-                
+            year = int(year_match.group(1))
+
             # Only process recent expirations (likely deaths)
             if year <= 2023:
                 continue
                 
-            first_name = row.get('First Name', '').strip()
-            last_name = row.get('Last Name', '').strip()
+            first_name = row[fn_i].strip()
+            last_name = row[ln_i].strip()
             
             # Skip if names are empty or too short
             if not first_name or not last_name or len(first_name) < 2 or len(last_name) < 2:
@@ -190,24 +109,33 @@ def test_mode_process_licenses(file_path, writer, output_file, delay_range=(2, 4
                 if found:
                     total_found += 1
                     print(f"✓ FOUND: {first_name} {last_name} (Index: {idx})")
-                    writer.writerow(row)
-                    output_file.flush()  # Force write to disk
+                    # Only hits pay for dict construction
+                    writer.writerow(dict(zip(fieldnames, row)))
                 else:
                     print(f"✗ Not found: {first_name} {last_name} (Index: {idx})")
-                
-                # Save progress every 3 successful searches (more frequent for testing)
+
+                # Save progress every 3 successful searches (more frequent for
+                # testing); matches since the last checkpoint flush with it
                 if total_processed % 3 == 0:
+                    output_file.flush()
+                    os.fsync(output_file.fileno())
                     save_progress(file_path, idx, {
                         "total_found": total_found,
-                        "total_processed": total_processed
+                        "total_processed": total_processed,
+                        "byte_offset": row_offset,
+                        "fieldnames": fieldnames
                     })
                     print(f"🔄 Progress checkpoint: Found {total_found}/{total_processed} matches")
                 
             except Exception as e:
                 print(f"❌ Error processing {first_name} {last_name}: {e}")
+                output_file.flush()
+                os.fsync(output_file.fileno())
                 save_progress(file_path, idx, {
                     "total_found": total_found,
                     "total_processed": total_processed,
+                    "byte_offset": row_offset,
+                    "fieldnames": fieldnames,
                     "error": str(e)
                 })
                 print(f"💾 Progress saved due to error. Processed {total_processed} entries, found {total_found} matches.")
@@ -1,122 +1,143 @@
+import atexit
 import csv
-import requests
+import aiohttp
+import asyncio
 import time
-import random
-from datetime import datetime
 import sys
 import os
-import json
-from urllib.parse import quote
+import sqlite3
+import pandas as pd
 
+from legacy_client import (HEADERS, search_legacy_obituary_async,
+                           save_progress, load_progress)
 
-def search_legacy_obituary(first_name, last_name, max_retries=3):
-    """
-    Search for obituary with exponential backoff retry logic
-    """
-    # URL encode the names to handle special characters
-    encoded_first = quote(first_name.strip())
-    encoded_last = quote(last_name.strip())
-
-    url = (
-        "https://www.legacy.com/api/_frontend/search"
-        "?countryIdList=1"
-        "&endDate=12-01-2025"
-        f"&firstName={encoded_first}"
-        "&keyword="
-        f"&lastName={encoded_last}"
-        "&limit=50"
-        "&noticeType=all"
-        "&regionIdList=41"
-        "&session_id="
-        "&startDate=01-01-2023"
-    )
-
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36",
-        "accept": "*/*",
-        "referer": "https://www.legacy.com/obituaries/search",
-        "accept-language": "en-US,en;q=0.9",
-        "accept-encoding": "gzip, deflate, br",
-        "cache-control": "no-cache",
-        "pragma": "no-cache"
-    }
-
-    for attempt in range(max_retries):
-        try:
-            response = requests.get(url, headers=headers, timeout=30)
-
-            # Check for rate limiting or captcha
-            if response.status_code == 429:
-                print(f"Rate limited (429) on attempt {attempt + 1}")
-                if attempt < max_retries - 1:
-                    # Exponential backoff: 1, 2, 4 minutes
-                    wait_time = (2 ** attempt) * 60
-                    print(f"Waiting {wait_time} seconds before retry...")
-                    time.sleep(wait_time)
-                    continue
-                else:
-                    raise Exception("Rate limited - max retries exceeded")
+CACHE_PATH = 'legacy_cache.sqlite'
+CACHE_TTL = 7 * 86400  # Re-search a name after a week
 
-            if response.status_code == 403:
-                print("Blocked (403) - possible IP ban or captcha")
-                raise Exception("Blocked by server")
 
-            if "captcha" in response.text.lower():
-                print("Captcha detected")
-                raise Exception("Captcha required")
+def open_cache(path=CACHE_PATH):
+    """Open (creating if needed) the on-disk search-result cache"""
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, found INTEGER, ts INTEGER)")
+    return conn
 
-            if response.status_code != 200:
-                print(f"HTTP {response.status_code}: {response.text[:100]}")
-                if attempt < max_retries - 1:
-                    time.sleep(5)
-                    continue
-                else:
-                    return False  # Assume no match on persistent errors
 
-            data = response.json()
-            return data.get("totalRecordCount", 0) > 0
+def cache_get(conn, key, ttl=CACHE_TTL):
+    """Return the cached found flag for key, or None if missing/expired"""
+    row = conn.execute(
+        "SELECT found FROM cache WHERE key=? AND ts>?",
+        (key, int(time.time()) - ttl)).fetchone()
+    return None if row is None else bool(row[0])
 
-        except requests.exceptions.RequestException as e:
-            print(f"Request error on attempt {attempt + 1}: {e}")
-            if attempt < max_retries - 1:
-                time.sleep(5)
-                continue
-            else:
-                return False  # Assume no match on persistent connection errors
 
-    return False
+def cache_put(conn, key, found):
+    conn.execute(
+        "INSERT OR REPLACE INTO cache (key, found, ts) VALUES (?, ?, ?)",
+        (key, int(found), int(time.time())))
+    conn.commit()
 
 
-def save_progress(file_path, idx, additional_data=None):
-    """Save progress with additional metadata"""
-    progress_file = f"{os.path.splitext(os.path.basename(file_path))[0]}_progress.json"
-    progress_data = {
-        "last_processed_index": idx,
-        "timestamp": datetime.now().isoformat(),
-        "file_path": file_path
-    }
-    if additional_data:
-        progress_data.update(additional_data)
+def cache_key(first_name, last_name):
+    return f"{first_name.strip().lower()}|{last_name.strip().lower()}"
 
-    with open(progress_file, 'w') as pf:
-        json.dump(progress_data, pf, indent=2)
 
+class TokenBucket:
+    """Token bucket that paces outbound requests to a fixed rate"""
 
-def load_progress(file_path):
-    """Load progress from file"""
-    progress_file = f"{os.path.splitext(os.path.basename(file_path))[0]}_progress.json"
-    try:
-        with open(progress_file, 'r') as pf:
-            data = json.load(pf)
-            return data.get("last_processed_index", 0)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return 0
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
 
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            # Sleep just long enough for the next token to accrue
+            await asyncio.sleep((1 - self.tokens) / self.rate)
 
-# def process_licenses(file_path, writer, out_csv, delay_range=(8, 15)):
-def process_licenses(file_path, writer, out_csv, delay_range=(1, 2)):
+
+class AIMDLimiter(TokenBucket):
+    """Token bucket whose rate adapts to what the server tolerates.
+
+    Additive increase: five consecutive successes raise the refill rate
+    by 0.5 req/s up to max_rate. Multiplicative decrease: any 429/403
+    halves it (floored at min_rate). Throughput converges on the
+    server's actual tolerance instead of a hardcoded guess.
     """
-    Process license file with improved error handling and progress tracking
+
+    def __init__(self, rate=1.0, min_rate=0.2, max_rate=10.0):
+        super().__init__(rate, capacity=1)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.ok_streak = 0
+
+    def record_success(self):
+        self.ok_streak += 1
+        if self.ok_streak >= 5:
+            self.ok_streak = 0
+            new_rate = min(self.rate + 0.5, self.max_rate)
+            if new_rate != self.rate:
+                self.rate = new_rate
+                print(f"Rate controller: raising to {self.rate:.1f} req/s")
+
+    def record_throttle(self):
+        self.ok_streak = 0
+        new_rate = max(self.rate * 0.5, self.min_rate)
+        if new_rate != self.rate:
+            self.rate = new_rate
+            print(f"Rate controller: throttled, halving to {self.rate:.1f} req/s")
+
+
+_CSV_CHUNK_ROWS = 4096
+_YEAR_EXTRACT_RE = r'([0-9]{4})\s*$'
+
+
+def iter_candidates(file_path, start_idx=0):
+    """Yield (idx, first_name, last_name, row) for rows worth searching.
+
+    The date and name filters run vectorized over pandas chunks, so rows
+    that are trivially ineligible (expiration year <= 2023, short names)
+    never touch the per-row Python loop.
+    """
+    for chunk in pd.read_csv(file_path, dtype=str, keep_default_na=False,
+                             chunksize=_CSV_CHUNK_ROWS):
+        if chunk.index[-1] < start_idx:
+            continue  # Entire chunk already processed on a prior run
+
+        years = pd.to_numeric(
+            chunk['Expiration Date'].str.extract(_YEAR_EXTRACT_RE, expand=False),
+            errors='coerce')
+        firsts = chunk['First Name'].str.strip()
+        lasts = chunk['Last Name'].str.strip()
+
+        # Only recent expirations (likely deaths) with plausible names
+        mask = ((years > 2023)
+                & (firsts.str.len() >= 2)
+                & (lasts.str.len() >= 2)
+                & (chunk.index >= start_idx))
+        if not mask.any():
+            continue
+
+        selected = chunk.loc[mask]
+        for idx, row in zip(selected.index, selected.to_dict('records')):
+            yield int(idx), firsts.at[idx], lasts.at[idx], row
+
+
+async def process_licenses(file_path, writer, out_csv, max_concurrent=10,
+                           requests_per_second=10):
+    """
+    Process license file with a paced worker pool and progress tracking.
+
+    requests_per_second is the ceiling; the adaptive limiter works its
+    way up from 1 req/s and backs off when the server pushes back.
     """
     start_idx = load_progress(file_path)
     total_found = 0
@@ -125,84 +146,149 @@ def process_licenses(file_path, writer, out_csv, delay_range=(1, 2)):
     print(f"Starting processing of {file_path}")
     print(f"Resuming from index: {start_idx}")
 
+    # Cheap line count for the progress message; rows themselves are streamed
     with open(file_path, mode='r') as file:
-        reader = csv.DictReader(file)
-        rows = list(reader)
-        total_rows = len(rows)
-
-        print(f"Total rows to process: {total_rows - start_idx}")
-
-        for idx, row in enumerate(rows):
-            if idx < start_idx:
-                continue
-
-            # Skip rows with invalid expiration dates
-            exp_date = row.get('Expiration Date', '').strip()
-            if not exp_date:
-                continue
-
+        total_rows = max(sum(1 for _ in file) - 1, 0)
+
+    print(f"Total rows to process: {max(total_rows - start_idx, 0)}")
+
+    sem = asyncio.Semaphore(max_concurrent)
+    # Start conservatively and let the AIMD controller find the ceiling
+    bucket = AIMDLimiter(max_rate=requests_per_second)
+    queue = asyncio.Queue(maxsize=max_concurrent * 2)
+    results = asyncio.Queue()
+    stop = asyncio.Event()  # Set on fatal errors so workers drain without searching
+    outstanding = set()  # Indices queued or in flight, not yet consumed
+    cache_conn = open_cache()
+    inflight = {}  # key -> future, so duplicate names share one request
+    connector = aiohttp.TCPConnector(limit=max_concurrent * 2, ttl_dns_cache=300)
+    timeout = aiohttp.ClientTimeout(total=30, connect=10)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout,
+                                     headers=HEADERS) as session:
+
+        async def lookup(first_name, last_name):
+            key = cache_key(first_name, last_name)
+            cached = cache_get(cache_conn, key)
+            if cached is not None:
+                return cached
+
+            pending = inflight.get(key)
+            if pending is not None:
+                # Another worker is already searching this name; share its result
+                return await pending
+
+            future = asyncio.get_running_loop().create_future()
+            inflight[key] = future
             try:
-                # Handle different date formats
-                if '/' in exp_date:
-                    year = int(exp_date.split('/')[-1])
-                elif '-' in exp_date:
-                    year = int(exp_date.split('-')[-1])
-                else:
+                await bucket.acquire()
+                found = await search_legacy_obituary_async(
+                    session, first_name, last_name, sem, limiter=bucket)
+            except Exception as e:
+                future.set_exception(e)
+                future.exception()  # Mark retrieved in case no worker is waiting
+                raise
+            else:
+                cache_put(cache_conn, key, found)
+                future.set_result(found)
+                return found
+            finally:
+                inflight.pop(key, None)
+
+        async def produce():
+            # Candidates stream out of the chunked pandas prefilter
+            for candidate in iter_candidates(file_path, start_idx):
+                outstanding.add(candidate[0])
+                await queue.put(candidate)
+            for _ in range(max_concurrent):
+                await queue.put(None)  # One sentinel per worker
+
+        async def worker():
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+                if stop.is_set():
+                    continue
+                idx, first_name, last_name, row = item
+                try:
+                    found = await lookup(first_name, last_name)
+                    await results.put((idx, first_name, last_name, row, found, None))
+                except Exception as e:
+                    await results.put((idx, first_name, last_name, row, False, e))
+
+        async def consume():
+            nonlocal total_found, total_processed
+            while True:
+                item = await results.get()
+                if item is None:
+                    break
+                idx, first_name, last_name, row, found, error = item
+
+                if error is not None:
+                    if stop.is_set():
+                        continue  # Error checkpoint already written
+                    print(f"Error during lookup: {error}")
+                    stop.set()
+                    out_csv.flush()
+                    os.fsync(out_csv.fileno())
+                    # The failed row is still outstanding, so min() resumes
+                    # at or before it instead of rewinding to start_idx
+                    save_progress(file_path,
+                                  min(outstanding) if outstanding else start_idx, {
+                        "total_found": total_found,
+                        "total_processed": total_processed,
+                        "error": str(error)
+                    })
+                    print(
+                        f"Progress saved due to error. Processed {total_processed} entries, found {total_found} matches.")
                     continue
-            except (ValueError, IndexError):
-                continue
-
-            # Only process recent expirations (likely deaths)
-            if year <= 2023:
-                continue
-
-            first_name = row.get('First Name', '').strip()
-            last_name = row.get('Last Name', '').strip()
 
-            # Skip if names are empty or too short
-            if not first_name or not last_name or len(first_name) < 2 or len(last_name) < 2:
-                continue
+                if stop.is_set():
+                    # Drain in-flight results without checkpointing, so the
+                    # conservative error save stays the last one on disk
+                    continue
 
-            try:
-                found = search_legacy_obituary(first_name, last_name)
+                outstanding.discard(idx)
                 total_processed += 1
 
                 if found:
                     total_found += 1
                     print(f"✓ FOUND: {first_name} {last_name} (Index: {idx})")
                     writer.writerow(row)
-                    out_csv.flush()  # Force write to disk
                 else:
                     print(
                         f"✗ Not found: {first_name} {last_name} (Index: {idx})")
 
-                # Save progress every 10 successful searches
+                # Save progress every 10 successful searches; matches written
+                # since the last checkpoint are flushed to disk with it.
+                # Results finish out of order, so checkpoint below the oldest
+                # row still in flight, never the index we happened to consume
                 if total_processed % 10 == 0:
-                    save_progress(file_path, idx, {
+                    out_csv.flush()
+                    os.fsync(out_csv.fileno())
+                    save_progress(file_path,
+                                  min(outstanding) if outstanding else idx, {
                         "total_found": total_found,
                         "total_processed": total_processed
                     })
                     print(
                         f"Progress saved. Found {total_found}/{total_processed} matches so far.")
 
-            except Exception as e:
-                print(f"Error processing {first_name} {last_name}: {e}")
-                save_progress(file_path, idx, {
-                    "total_found": total_found,
-                    "total_processed": total_processed,
-                    "error": str(e)
-                })
-                print(
-                    f"Progress saved due to error. Processed {total_processed} entries, found {total_found} matches.")
-                return False  # Indicate failure
-
-            # Variable delay between requests
-            delay = random.uniform(*delay_range)
-            print(f"Waiting {delay:.1f} seconds... ({idx + 1}/{total_rows})")
-            time.sleep(delay)
+        consumer = asyncio.ensure_future(consume())
+        try:
+            await asyncio.gather(produce(),
+                                 *[worker() for _ in range(max_concurrent)])
+            await results.put(None)
+            await consumer
+        finally:
+            cache_conn.close()
+
+    if stop.is_set():
+        return False  # Indicate failure
 
     # Save final progress
-    save_progress(file_path, len(rows), {
+    save_progress(file_path, total_rows, {
         "total_found": total_found,
         "total_processed": total_processed,
         "completed": True
@@ -213,7 +299,7 @@ def process_licenses(file_path, writer, out_csv, delay_range=(1, 2)):
     return True
 
 
-def main():
+async def main():
     """Main execution function"""
     nursing_file = './nursing-licenses.csv'
     physician_file = './physician-licenses.csv'
@@ -244,31 +330,44 @@ def main():
 
     with open(output_file, file_mode, newline='') as out_csv:
         writer = csv.DictWriter(out_csv, fieldnames=fieldnames)
+        # Belt and braces: buffered matches survive an unexpected exit
+        atexit.register(lambda: out_csv.closed or out_csv.flush())
 
         # Write header only if creating new file
         if file_mode == 'w':
             writer.writeheader()
 
-        for file_path in files_to_process:
-            print(f"\n{'='*50}")
-            print(f"Processing: {file_path}")
-            print(f"{'='*50}")
-
-            if not os.path.exists(file_path):
-                print(f"Warning: File {file_path} not found. Skipping.")
-                continue
+        try:
+            for file_path in files_to_process:
+                print(f"\n{'='*50}")
+                print(f"Processing: {file_path}")
+                print(f"{'='*50}")
 
-            success = process_licenses(file_path, writer, out_csv)
+                if not os.path.exists(file_path):
+                    print(f"Warning: File {file_path} not found. Skipping.")
+                    continue
 
-            if not success:
-                print(
-                    f"Processing failed for {file_path}. Check the error and restart.")
-                break
+                success = await process_licenses(file_path, writer, out_csv)
 
-            print(f"Successfully completed {file_path}")
+                if not success:
+                    print(
+                        f"Processing failed for {file_path}. Check the error and restart.")
+                    break
+
+                print(f"Successfully completed {file_path}")
+        except asyncio.CancelledError:
+            # asyncio.run() turns Ctrl-C into cancellation of this task;
+            # KeyboardInterrupt itself only surfaces at the run() call below
+            out_csv.flush()
+            os.fsync(out_csv.fileno())
+            print("\nInterrupted - matches flushed to disk. Rerun to resume.")
+            raise
 
     print("\nAll processing complete!")
 
 
 if __name__ == "__main__":
-    main()
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass  # Already flushed and reported on cancellation